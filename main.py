@@ -1,23 +1,34 @@
 import os
+import gzip
+import asyncio
 import hashlib
 import logging
+import struct
+import tempfile
 from pathlib import Path
-from typing import Optional, Union
+from typing import Dict, List, Optional, Union
 from datetime import datetime
+from functools import cached_property
 from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import FastAPI, HTTPException, Query
-from pydantic import BaseModel, field_validator
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, Field, field_validator
 import google.generativeai as genai
 from dotenv import load_dotenv
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
 
 # Import database functions
+from src.cache import TTLCache
+from src.static import PrecompressedStaticFiles, COMPRESSED_SUFFIX
 from src.database import (
     get_simulation_by_cache_key,
+    get_access_stats,
+    record_simulation_access,
+    flush_pending_accesses,
+    migrate_cache_keys,
     insert_simulation,
     get_all_simulations,
-    get_simulation_count,
     delete_simulation_by_cache_key,
     delete_all_simulations,
     get_statistics,
@@ -50,6 +61,7 @@ logger.info(f"Base URL configured: {BASE_URL}")
 
 genai.configure(api_key=GEMINI_API_KEY)
 MODEL_NAME = "gemini-3-pro-preview"
+model = genai.GenerativeModel(MODEL_NAME)
 logger.info(f"Gemini API configured with model: {MODEL_NAME}")
 
 # Cache directory for storing generated HTML files
@@ -57,6 +69,66 @@ CACHE_DIR = Path("html_cache")
 CACHE_DIR.mkdir(exist_ok=True)
 logger.info(f"Cache directory initialized at: {CACHE_DIR}")
 
+# Prompt sent to Gemini, filled in per request with str.format
+PROMPT_TEMPLATE = """
+Create a complete, self-contained, interactive HTML page for an educational simulation with the following requirements:
+
+Subject: {subject}
+Chapter: {chapter}
+Topic: {topic}
+Grade/Level: {level}
+
+Requirements:
+1. Create a 3D interactive simulation using Three.js if required else 2D interactive simulation using Canvas or SVG
+2. The simulation should be highly educational and help students understand the concept through interaction
+3. Include clear instructions for the user on how to interact with the simulation
+4. Add controls (sliders, buttons, inputs) to modify parameters and observe changes
+5. Include educational explanations and labels
+6. Make it visually appealing with good UI/UX
+7. The HTML must be complete and ready to run (include all necessary CDN links)
+8. Add responsive design for mobile and desktop
+9. Include interactive elements that demonstrate the core concepts
+10. Add reset and play/pause controls where applicable
+
+Important:
+- Use only CDN links for external libraries (Three.js for 3D, no npm packages)
+- Make it production-ready and bug-free
+- Focus on educational value and interactivity
+- Include color-coded visual elements to aid understanding
+- Add tooltips or info boxes explaining what's happening
+
+Return ONLY the complete HTML code, nothing else. No markdown, no explanations, just the HTML.
+"""
+
+# In-memory cache of simulation metadata keyed by cache_key. Only columns
+# that never change after insert are kept; access statistics are read live.
+simulation_cache = TTLCache(maxsize=512, ttl=3600)
+CACHED_FIELDS = (
+    "id", "cache_key", "topic", "topic_id", "chapter", "chapter_id",
+    "subject", "subject_id", "level", "simulation_type", "file_path", "created_at",
+)
+
+# Cache-Control sent with generated HTML files requested through a versioned
+# URL (see get_file_url). A regenerated simulation gets a new row ID and so a
+# new URL, which lets browsers keep each version indefinitely.
+STATIC_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Threads used to unlink files when clearing the cache
+FILE_DELETE_WORKERS = 16
+
+# Seconds between writes of buffered access statistics
+ACCESS_FLUSH_INTERVAL = 30
+
+
+async def flush_accesses_periodically():
+    """Background task that writes buffered access statistics"""
+    while True:
+        await asyncio.sleep(ACCESS_FLUSH_INTERVAL)
+        try:
+            await run_in_threadpool(flush_pending_accesses)
+        except Exception as e:
+            logger.error(f"Error flushing access statistics: {str(e)}")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -69,17 +141,35 @@ async def lifespan(app: FastAPI):
     logger.info(f"Cache Directory: {CACHE_DIR}")
     logger.info("="*50)
     
+    rekeyed, purged = migrate_cache_keys(cache_key_for_row)
+    if rekeyed or purged:
+        logger.info(f"Migrated cache keys - rekeyed: {rekeyed}, purged: {purged}")
+    
+    flush_task = asyncio.create_task(flush_accesses_periodically())
+    
     yield
     
     # Shutdown
     logger.info("HTML Simulator API Shutting Down")
+    flush_task.cancel()
+    try:
+        await flush_task
+    except asyncio.CancelledError:
+        pass
+    flushed = await run_in_threadpool(flush_pending_accesses)
+    logger.info(f"Flushed access statistics for {flushed} simulations")
 
 
 # Initialize FastAPI app with lifespan
 app = FastAPI(title="HTML Simulator API", version="0.2.0", lifespan=lifespan)
 
 # Mount static files directory to serve HTML files
-app.mount("/static", StaticFiles(directory=str(CACHE_DIR)), name="static")
+# StaticFiles already answers If-None-Match/If-Modified-Since with 304
+app.mount(
+    "/static",
+    PrecompressedStaticFiles(directory=str(CACHE_DIR), cache_control=STATIC_CACHE_CONTROL),
+    name="static",
+)
 
 # CORS middleware
 app.add_middleware(
@@ -90,6 +180,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Ranges that fit the fixed-width fields packed into the cache key
+ID_MIN, ID_MAX = -(2**63), 2**63 - 1
+LEVEL_MIN, LEVEL_MAX = -(2**31), 2**31 - 1
+
+
 class SimulationRequest(BaseModel):
     topic: str
     topic_id: Union[int, str, None] = None
@@ -97,7 +192,7 @@ class SimulationRequest(BaseModel):
     chapter_id: Union[int, str, None] = None
     subject: str
     subject_id: Union[int, str, None] = None
-    level: int
+    level: int = Field(ge=LEVEL_MIN, le=LEVEL_MAX)
     
     @field_validator('topic_id', 'chapter_id', 'subject_id', mode='before')
     @classmethod
@@ -105,14 +200,19 @@ class SimulationRequest(BaseModel):
         """Convert string IDs to integers"""
         if v is None:
             return None
-        if isinstance(v, int):
-            return v
         if isinstance(v, str):
             try:
-                return int(v)
+                v = int(v)
             except ValueError:
                 raise ValueError(f"ID must be a valid integer, got: {v}")
+        if isinstance(v, int) and not ID_MIN <= v <= ID_MAX:
+            raise ValueError(f"ID must fit in a signed 64-bit integer, got: {v}")
         return v
+    
+    @cached_property
+    def cache_key(self) -> str:
+        """Cache key for this request, computed once"""
+        return generate_cache_key(self)
 
 
 class SimulationResponse(BaseModel):
@@ -136,7 +236,7 @@ class CacheCheckRequest(BaseModel):
     chapter_id: Union[int, str, None] = None
     subject: str
     subject_id: Union[int, str, None] = None
-    level: int
+    level: int = Field(ge=LEVEL_MIN, le=LEVEL_MAX)
     
     @field_validator('topic_id', 'chapter_id', 'subject_id', mode='before')
     @classmethod
@@ -144,14 +244,19 @@ class CacheCheckRequest(BaseModel):
         """Convert string IDs to integers"""
         if v is None:
             return None
-        if isinstance(v, int):
-            return v
         if isinstance(v, str):
             try:
-                return int(v)
+                v = int(v)
             except ValueError:
                 raise ValueError(f"ID must be a valid integer, got: {v}")
+        if isinstance(v, int) and not ID_MIN <= v <= ID_MAX:
+            raise ValueError(f"ID must fit in a signed 64-bit integer, got: {v}")
         return v
+    
+    @cached_property
+    def cache_key(self) -> str:
+        """Cache key for this request, computed once"""
+        return generate_cache_key(self)
 
 
 class CacheCheckResponse(BaseModel):
@@ -168,28 +273,134 @@ class CacheCheckResponse(BaseModel):
     message: str
 
 
+class SimulationSummary(BaseModel):
+    """Simulation entry returned by listing and search"""
+    cache_key: str
+    file_url: str
+    topic: str
+    chapter: str
+    subject: str
+    level: int
+    created_at: Optional[str] = None
+    access_count: Optional[int] = None
+
+
+class SimulationListResponse(BaseModel):
+    """Response model for listing simulations"""
+    total: int
+    limit: Optional[int] = None
+    offset: int
+    count: int
+    simulations: List[SimulationSummary]
+
+
+class SimulationSearchResponse(BaseModel):
+    """Response model for searching simulations"""
+    query: str
+    count: int
+    results: List[SimulationSummary]
+
+
+class MostAccessedSimulation(BaseModel):
+    """Entry in the most accessed simulations statistic"""
+    topic: str
+    subject: str
+    level: int
+    access_count: Optional[int] = None
+
+
+class StatisticsResponse(BaseModel):
+    """Response model for database statistics"""
+    total_simulations: int
+    unique_subjects: int
+    unique_levels: int
+    total_accesses: Optional[int] = None
+    avg_accesses_per_simulation: Optional[float] = None
+    most_accessed: List[MostAccessedSimulation]
+
+
+def compute_cache_key(
+    topic_id: Optional[int],
+    chapter_id: Optional[int],
+    subject_id: Optional[int],
+    level: int
+) -> str:
+    """Hash the integer IDs and level into a cache key"""
+    key_bytes = struct.pack("<qqqi", topic_id or 0, chapter_id or 0, subject_id or 0, level)
+    return hashlib.blake2b(key_bytes, digest_size=16).hexdigest()
+
+
 def generate_cache_key(request: SimulationRequest) -> str:
     """Generate a unique cache key based on request parameters"""
-    key_string = f"{request.topic_id}_{request.chapter_id}_{request.subject_id}_{request.level}"
-    cache_key = hashlib.md5(key_string.encode()).hexdigest()
+    cache_key = compute_cache_key(
+        request.topic_id,
+        request.chapter_id,
+        request.subject_id,
+        request.level,
+    )
     logger.debug(f"Generated cache key: {cache_key} for topic: {request.topic}")
     return cache_key
 
 
-def get_file_url(cache_key: str) -> str:
-    """Generate the full URL for accessing the HTML file"""
+def cache_key_for_row(row: Dict) -> Optional[str]:
+    """Cache key for a stored simulation, or None if its IDs cannot be keyed"""
+    try:
+        return compute_cache_key(row["topic_id"], row["chapter_id"], row["subject_id"], row["level"])
+    except struct.error:
+        return None
+
+
+def get_file_url(cache_key: str, version: int) -> str:
+    """
+    Generate the full URL for accessing the HTML file.
+    The version is the simulation's row ID, which changes whenever the simulation is regenerated.
+    """
     file_name = f"{cache_key}.html"
-    return f"{BASE_URL}/static/{file_name}"
+    return f"{BASE_URL}/static/{file_name}?v={version}"
+
+
+def get_compressed_path(file_path: Path) -> Path:
+    """Path of the precompressed copy of an HTML file"""
+    return file_path.with_name(file_path.name + COMPRESSED_SUFFIX)
+
+
+def delete_html_files(file_path: Path) -> bool:
+    """Delete an HTML file and its compressed copy; returns whether the HTML file existed"""
+    get_compressed_path(file_path).unlink(missing_ok=True)
+    try:
+        file_path.unlink()
+    except FileNotFoundError:
+        # Already removed, possibly by a concurrent delete in another worker
+        return False
+    return True
 
 
-def get_cached_simulation(cache_key: str) -> Optional[dict]:
+def get_cached_simulation(cache_key: str, include_access_stats: bool = False) -> Optional[dict]:
     """Retrieve cached simulation metadata if it exists"""
     try:
+        simulation = simulation_cache.get(cache_key)
+        # Another worker may have deleted the simulation since it was cached
+        if simulation and not Path(simulation["file_path"]).exists():
+            simulation_cache.delete(cache_key)
+            simulation = None
+        if simulation and include_access_stats:
+            access_stats = get_access_stats(cache_key)
+            if access_stats:
+                simulation = {**simulation, **access_stats}
+            else:
+                simulation_cache.delete(cache_key)
+                simulation = None
+        if simulation:
+            record_simulation_access(cache_key)
+            logger.info(f"Retrieved cached simulation from memory: {cache_key} (Topic: {simulation.get('topic')})")
+            return dict(simulation)
+        
         simulation = get_simulation_by_cache_key(cache_key)
         
         if simulation:
             file_path = Path(simulation["file_path"])
             if file_path.exists():
+                simulation_cache.set(cache_key, {field: simulation[field] for field in CACHED_FIELDS})
                 logger.info(f"Retrieved cached simulation: {cache_key} (Topic: {simulation.get('topic')})")
                 return simulation
             else:
@@ -201,20 +412,31 @@ def get_cached_simulation(cache_key: str) -> Optional[dict]:
         return None
 
 
-def save_html_to_cache(cache_key: str, html_content: str, request: SimulationRequest):
-    """Save generated HTML to cache and database"""
+def write_temp_file(data: bytes) -> Path:
+    """Write data to a temporary file in the cache directory, so it can be moved into place atomically"""
+    fd, temp_path = tempfile.mkstemp(dir=CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(data)
+    return Path(temp_path)
+
+
+def save_html_to_cache(cache_key: str, html_content: str, request: SimulationRequest) -> int:
+    """Save generated HTML to cache and database, returning the simulation ID"""
+    temp_paths = []
     try:
         file_name = f"{cache_key}.html"
         file_path = CACHE_DIR / file_name
         
-        # Save HTML file
-        with open(file_path, "w", encoding="utf-8") as f:
-            f.write(html_content)
-        
-        logger.info(f"Saved HTML file: {file_path}")
+        # Write the HTML file and a gzip copy served to clients that accept it to temp files first,
+        # so readers never see a partially written or mismatched pair
+        html_bytes = html_content.encode("utf-8")
+        temp_html = write_temp_file(html_bytes)
+        temp_paths.append(temp_html)
+        temp_compressed = write_temp_file(gzip.compress(html_bytes, compresslevel=6))
+        temp_paths.append(temp_compressed)
         
         # Insert into database with integer IDs
-        insert_simulation(
+        sim_id, inserted = insert_simulation(
             cache_key=cache_key,
             topic=request.topic,
             topic_id=request.topic_id,
@@ -227,54 +449,53 @@ def save_html_to_cache(cache_key: str, html_content: str, request: SimulationReq
             file_path=str(file_path)
         )
         
+        if not inserted:
+            # A concurrent identical request already saved this simulation; keep its files
+            logger.info(f"Simulation already cached for key: {cache_key}, discarding duplicate")
+            return sim_id
+        
+        os.replace(temp_compressed, get_compressed_path(file_path))
+        os.replace(temp_html, file_path)
+        logger.info(f"Saved HTML file: {file_path}")
+        
         logger.info(f"Saved simulation to database - Topic: {request.topic}, Subject: {request.subject}, Level: {request.level}")
+        return sim_id
     except Exception as e:
         logger.error(f"Error saving simulation to cache: {str(e)}")
         raise
+    finally:
+        for temp_path in temp_paths:
+            temp_path.unlink(missing_ok=True)
 
 
 def generate_html_with_gemini(request: SimulationRequest) -> str:
     """Generate HTML simulation using Gemini API"""
     
-    prompt = f"""
-Create a complete, self-contained, interactive HTML page for an educational simulation with the following requirements:
-
-Subject: {request.subject}
-Chapter: {request.chapter}
-Topic: {request.topic}
-Grade/Level: {request.level}
-
-Requirements:
-1. Create a 3D interactive simulation using Three.js if required else 2D interactive simulation using Canvas or SVG
-2. The simulation should be highly educational and help students understand the concept through interaction
-3. Include clear instructions for the user on how to interact with the simulation
-4. Add controls (sliders, buttons, inputs) to modify parameters and observe changes
-5. Include educational explanations and labels
-6. Make it visually appealing with good UI/UX
-7. The HTML must be complete and ready to run (include all necessary CDN links)
-8. Add responsive design for mobile and desktop
-9. Include interactive elements that demonstrate the core concepts
-10. Add reset and play/pause controls where applicable
-
-Important:
-- Use only CDN links for external libraries (Three.js for 3D, no npm packages)
-- Make it production-ready and bug-free
-- Focus on educational value and interactivity
-- Include color-coded visual elements to aid understanding
-- Add tooltips or info boxes explaining what's happening
-
-Return ONLY the complete HTML code, nothing else. No markdown, no explanations, just the HTML.
-"""
+    prompt = PROMPT_TEMPLATE.format(
+        subject=request.subject,
+        chapter=request.chapter,
+        topic=request.topic,
+        level=request.level,
+    )
     
     try:
         logger.info(f"Generating HTML with Gemini for topic: {request.topic}")
         start_time = datetime.now()
         
-        model = genai.GenerativeModel(MODEL_NAME)
-        response = model.generate_content(prompt)
+        response = model.generate_content(prompt, stream=True)
+        
+        # Consume the stream; chunk.text raises for chunks without parts (such
+        # as the final one carrying only finish_reason), so read the text from
+        # the aggregated response afterwards
+        chunk_count = 0
+        for _ in response:
+            if chunk_count == 0:
+                first_chunk_time = (datetime.now() - start_time).total_seconds()
+                logger.info(f"First Gemini chunk received after {first_chunk_time:.2f} seconds")
+            chunk_count += 1
         
         generation_time = (datetime.now() - start_time).total_seconds()
-        logger.info(f"Gemini generation completed in {generation_time:.2f} seconds")
+        logger.info(f"Gemini generation completed in {generation_time:.2f} seconds ({chunk_count} chunks)")
         
         # Extract HTML from response
         html_content = response.text.strip()
@@ -329,15 +550,15 @@ async def generate_simulation(request: SimulationRequest):
     
     try:
         # Generate cache key
-        cache_key = generate_cache_key(request)
+        cache_key = request.cache_key
         
         # Check if cached version exists
-        cached_simulation = get_cached_simulation(cache_key)
+        cached_simulation = await run_in_threadpool(get_cached_simulation, cache_key)
         if cached_simulation:
             logger.info(f"Returning cached simulation for key: {cache_key}")
             return SimulationResponse(
                 cache_key=cache_key,
-                file_url=get_file_url(cache_key),
+                file_url=get_file_url(cache_key, cached_simulation["id"]),
                 topic=cached_simulation["topic"],
                 chapter=cached_simulation["chapter"],
                 subject=cached_simulation["subject"],
@@ -350,16 +571,16 @@ async def generate_simulation(request: SimulationRequest):
         logger.info(f"No cache found, generating new simulation for key: {cache_key}")
         
         # Generate new HTML using Gemini
-        html_content = generate_html_with_gemini(request)
+        html_content = await run_in_threadpool(generate_html_with_gemini, request)
         
         # Save to cache
-        save_html_to_cache(cache_key, html_content, request)
+        sim_id = await run_in_threadpool(save_html_to_cache, cache_key, html_content, request)
         
         logger.info(f"Successfully generated and cached new simulation for key: {cache_key}")
         
         return SimulationResponse(
             cache_key=cache_key,
-            file_url=get_file_url(cache_key),
+            file_url=get_file_url(cache_key, sim_id),
             topic=request.topic,
             chapter=request.chapter,
             subject=request.subject,
@@ -374,7 +595,7 @@ async def generate_simulation(request: SimulationRequest):
         raise
 
 
-@app.get("/simulations")
+@app.get("/simulations", response_model=SimulationListResponse)
 def list_simulations(
     limit: Optional[int] = Query(None, ge=1, le=100),
     offset: int = Query(0, ge=0),
@@ -384,7 +605,7 @@ def list_simulations(
     logger.info(f"Listing simulations - limit: {limit}, offset: {offset}, level: {level}")
     
     try:
-        simulations = get_all_simulations(
+        simulations, total = get_all_simulations(
             limit=limit,
             offset=offset,
             level=level
@@ -392,9 +613,7 @@ def list_simulations(
         
         # Add file_url to each simulation
         for sim in simulations:
-            sim["file_url"] = get_file_url(sim["cache_key"])
-        
-        total = get_simulation_count(level=level)
+            sim["file_url"] = get_file_url(sim["cache_key"], sim["id"])
         
         logger.info(f"Retrieved {len(simulations)} simulations (total: {total})")
         
@@ -410,7 +629,7 @@ def list_simulations(
         raise HTTPException(status_code=500, detail=f"Error retrieving simulations: {str(e)}")
 
 
-@app.get("/simulations/search")
+@app.get("/simulations/search", response_model=SimulationSearchResponse)
 def search_simulations_endpoint(
     q: str = Query(..., min_length=1, description="Search query"),
     fields: Optional[str] = Query(None, description="Comma-separated fields to search (topic,chapter,subject)")
@@ -427,7 +646,7 @@ def search_simulations_endpoint(
         
         # Add file_url to each result
         for result in results:
-            result["file_url"] = get_file_url(result["cache_key"])
+            result["file_url"] = get_file_url(result["cache_key"], result["id"])
         
         logger.info(f"Search returned {len(results)} results for query: '{q}'")
         
@@ -436,12 +655,15 @@ def search_simulations_endpoint(
             "count": len(results),
             "results": results
         }
+    except ValueError as e:
+        logger.warning(f"Invalid search request: {str(e)}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"Error searching simulations: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error searching simulations: {str(e)}")
 
 
-@app.get("/simulations/stats")
+@app.get("/simulations/stats", response_model=StatisticsResponse)
 def get_simulation_statistics():
     """Get database statistics including total simulations, subjects, and most accessed"""
     logger.info("Statistics request received")
@@ -461,14 +683,14 @@ def get_simulation(cache_key: str):
     logger.info(f"Fetching simulation metadata with cache_key: {cache_key}")
     
     try:
-        simulation = get_cached_simulation(cache_key)
+        simulation = get_cached_simulation(cache_key, include_access_stats=True)
         
         if not simulation:
             logger.warning(f"Simulation not found for cache_key: {cache_key}")
             raise HTTPException(status_code=404, detail="Simulation not found")
         
         # Add file_url to response
-        simulation["file_url"] = get_file_url(cache_key)
+        simulation["file_url"] = get_file_url(cache_key, simulation["id"])
         
         return simulation
     except HTTPException:
@@ -492,13 +714,13 @@ def delete_simulation(cache_key: str):
         
         # Delete file
         file_path = Path(simulation["file_path"])
-        if file_path.exists():
-            file_path.unlink()
+        if delete_html_files(file_path):
             logger.info(f"Deleted file: {file_path}")
         else:
             logger.warning(f"File not found for deletion: {file_path}")
         
         # Delete from database
+        simulation_cache.delete(cache_key)
         deleted = delete_simulation_by_cache_key(cache_key)
         
         if not deleted:
@@ -521,24 +743,19 @@ def clear_cache():
     logger.warning("Cache clear request received - deleting all simulations")
     
     try:
-        # Get all simulations
-        simulations = get_all_simulations()
-        
-        # Delete all HTML files
-        deleted_files = 0
-        for simulation in simulations:
-            file_path = Path(simulation["file_path"])
-            if file_path.exists():
-                file_path.unlink()
-                deleted_files += 1
-        
-        logger.info(f"Deleted {deleted_files} HTML files")
-        
         # Delete all database records
-        count = delete_all_simulations()
+        simulation_cache.clear()
+        file_paths = delete_all_simulations()
+        count = len(file_paths)
         
         logger.info(f"Cleared {count} database records")
         
+        # Delete all HTML files in parallel
+        with ThreadPoolExecutor(max_workers=FILE_DELETE_WORKERS) as executor:
+            deleted_files = sum(executor.map(delete_html_files, map(Path, file_paths)))
+        
+        logger.info(f"Deleted {deleted_files} HTML files")
+        
         return {
             "message": "Cache cleared successfully",
             "deleted_count": count,
@@ -559,17 +776,17 @@ async def check_cache(request: CacheCheckRequest):
     
     try:
         # Generate cache key
-        cache_key = generate_cache_key(request)
+        cache_key = request.cache_key
         
         # Check if cached version exists
-        cached_simulation = get_cached_simulation(cache_key)
+        cached_simulation = await run_in_threadpool(get_cached_simulation, cache_key, include_access_stats=True)
         
         if cached_simulation:
             logger.info(f"Cache HIT for key: {cache_key}")
             return CacheCheckResponse(
                 cached=True,
                 cache_key=cache_key,
-                file_url=get_file_url(cache_key),
+                file_url=get_file_url(cache_key, cached_simulation["id"]),
                 topic=cached_simulation["topic"],
                 chapter=cached_simulation["chapter"],
                 subject=cached_simulation["subject"],
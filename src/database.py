@@ -1,8 +1,11 @@
+import queue
 import sqlite3
 import logging
+import threading
+from collections import Counter
 from pathlib import Path
-from typing import Optional, List, Dict
-from datetime import datetime
+from typing import Callable, Optional, List, Dict, Tuple
+from datetime import datetime, timezone
 from contextlib import contextmanager
 
 # Configure logger
@@ -11,12 +14,65 @@ logger = logging.getLogger(__name__)
 # Database file path
 DB_FILE = Path("simulations.db")
 
+# Per-connection tuning. journal_mode=WAL is persistent in the database
+# file, so it is set once in init_db() instead.
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-65536",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA foreign_keys=ON",
+)
+
+# Columns returned by listing and search queries
+LIST_COLUMNS = "id, cache_key, topic, chapter, subject, level, created_at, access_count"
+
+# Columns indexed for full-text search
+SEARCH_FIELDS = ("topic", "chapter", "subject")
+
+# The trigram tokenizer cannot match terms shorter than this
+MIN_FTS_TERM_LENGTH = 3
+
+# Seconds to wait for a lock held by another connection or worker process
+BUSY_TIMEOUT = 30
+
+# Cache key scheme recorded in PRAGMA user_version once rows are migrated
+CACHE_KEY_VERSION = 1
+
+# Number of connections kept open and shared between request threads
+POOL_SIZE = 10
+
+_pool: "queue.Queue[sqlite3.Connection]" = queue.Queue(maxsize=POOL_SIZE)
+
+# Buffer access statistics in memory instead of writing them on every lookup
+BATCH_ACCESS_UPDATES = True
+
+# Access statistics buffered in memory and written by flush_pending_accesses()
+_pending_accesses: Counter = Counter()
+_last_accessed: Dict[str, str] = {}
+_access_lock = threading.Lock()
+
+
+def _create_connection() -> sqlite3.Connection:
+    """Open a new connection with row factory and PRAGMAs applied"""
+    conn = sqlite3.connect(DB_FILE, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
+def _init_pool():
+    """Fill the connection pool"""
+    for _ in range(POOL_SIZE):
+        _pool.put(_create_connection())
+    logger.info(f"Database connection pool initialized with {POOL_SIZE} connections")
+
 
 @contextmanager
 def get_db_connection():
-    """Context manager for database connections"""
-    conn = sqlite3.connect(DB_FILE)
-    conn.row_factory = sqlite3.Row
+    """Context manager that borrows a connection from the pool"""
+    conn = _pool.get()
     try:
         yield conn
         conn.commit()
@@ -25,7 +81,7 @@ def get_db_connection():
         logger.error(f"Database error: {str(e)}", exc_info=True)
         raise
     finally:
-        conn.close()
+        _pool.put(conn)
 
 
 def init_db():
@@ -34,6 +90,14 @@ def init_db():
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
+        # WAL lets readers run alongside the writer and needs fewer fsyncs
+        journal_mode = cursor.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        logger.info(f"SQLite journal mode: {journal_mode}")
+        
+        # Every worker process runs this on startup; take the write lock
+        # up front so concurrent workers apply the schema one at a time
+        cursor.execute("BEGIN IMMEDIATE")
+        
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS simulations (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -53,25 +117,221 @@ def init_db():
             )
         """)
         
-        # Create indexes for faster lookups
+        # Let list queries read rows in ORDER BY created_at DESC order
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_cache_key 
-            ON simulations(cache_key)
+            CREATE INDEX IF NOT EXISTS idx_created_at 
+            ON simulations(created_at DESC)
         """)
         
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_subject_level 
-            ON simulations(subject_id, level)
+            CREATE INDEX IF NOT EXISTS idx_level_created 
+            ON simulations(level, created_at DESC)
         """)
         
+        # Unused by any query (cache_key is already covered by its UNIQUE
+        # constraint); dropping them saves B-tree writes on every insert
+        cursor.execute("DROP INDEX IF EXISTS idx_cache_key")
+        cursor.execute("DROP INDEX IF EXISTS idx_topic")
+        cursor.execute("DROP INDEX IF EXISTS idx_subject_level")
+        
+        # Full-text index over the searchable columns, kept in sync by triggers
+        cursor.execute("""
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'simulations_fts'
+        """)
+        fts_exists = cursor.fetchone() is not None
+        
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS simulations_fts USING fts5(
+                topic, chapter, subject,
+                content='simulations',
+                content_rowid='id',
+                tokenize='trigram'
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS simulations_fts_insert
+            AFTER INSERT ON simulations BEGIN
+                INSERT INTO simulations_fts(rowid, topic, chapter, subject)
+                VALUES (new.id, new.topic, new.chapter, new.subject);
+            END
+        """)
+        
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS simulations_fts_delete
+            AFTER DELETE ON simulations BEGIN
+                INSERT INTO simulations_fts(simulations_fts, rowid, topic, chapter, subject)
+                VALUES ('delete', old.id, old.topic, old.chapter, old.subject);
+            END
+        """)
+        
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS simulations_fts_update
+            AFTER UPDATE OF topic, chapter, subject ON simulations BEGIN
+                INSERT INTO simulations_fts(simulations_fts, rowid, topic, chapter, subject)
+                VALUES ('delete', old.id, old.topic, old.chapter, old.subject);
+                INSERT INTO simulations_fts(rowid, topic, chapter, subject)
+                VALUES (new.id, new.topic, new.chapter, new.subject);
+            END
+        """)
+        
+        if not fts_exists:
+            # Index rows that were stored before the FTS table existed
+            cursor.execute("INSERT INTO simulations_fts(simulations_fts) VALUES ('rebuild')")
+            logger.info("Full-text search index built")
+        
+        # Running totals for get_statistics(), kept up to date by triggers
         cursor.execute("""
-            CREATE INDEX IF NOT EXISTS idx_topic 
-            ON simulations(topic_id, chapter_id, subject_id, level)
+            SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'simulation_stats'
+        """)
+        stats_exist = cursor.fetchone() is not None
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS simulation_stats (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                total_simulations INTEGER NOT NULL,
+                total_accesses INTEGER NOT NULL
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS simulation_subject_counts (
+                subject_id INTEGER PRIMARY KEY,
+                simulation_count INTEGER NOT NULL
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS simulation_level_counts (
+                level INTEGER PRIMARY KEY,
+                simulation_count INTEGER NOT NULL
+            )
+        """)
+        
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS simulations_stats_insert
+            AFTER INSERT ON simulations BEGIN
+                UPDATE simulation_stats
+                SET total_simulations = total_simulations + 1,
+                    total_accesses = total_accesses + COALESCE(new.access_count, 0)
+                WHERE id = 1;
+                INSERT INTO simulation_subject_counts (subject_id, simulation_count)
+                VALUES (new.subject_id, 1)
+                ON CONFLICT(subject_id) DO UPDATE SET simulation_count = simulation_count + 1;
+                INSERT INTO simulation_level_counts (level, simulation_count)
+                VALUES (new.level, 1)
+                ON CONFLICT(level) DO UPDATE SET simulation_count = simulation_count + 1;
+            END
+        """)
+        
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS simulations_stats_delete
+            AFTER DELETE ON simulations BEGIN
+                UPDATE simulation_stats
+                SET total_simulations = total_simulations - 1,
+                    total_accesses = total_accesses - COALESCE(old.access_count, 0)
+                WHERE id = 1;
+                UPDATE simulation_subject_counts
+                SET simulation_count = simulation_count - 1
+                WHERE subject_id = old.subject_id;
+                DELETE FROM simulation_subject_counts
+                WHERE subject_id = old.subject_id AND simulation_count <= 0;
+                UPDATE simulation_level_counts
+                SET simulation_count = simulation_count - 1
+                WHERE level = old.level;
+                DELETE FROM simulation_level_counts
+                WHERE level = old.level AND simulation_count <= 0;
+            END
+        """)
+        
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS simulations_stats_update
+            AFTER UPDATE OF access_count ON simulations BEGIN
+                UPDATE simulation_stats
+                SET total_accesses = total_accesses
+                    + COALESCE(new.access_count, 0) - COALESCE(old.access_count, 0)
+                WHERE id = 1;
+            END
+        """)
+        
+        if not stats_exist:
+            # Seed the totals from rows stored before the tables existed
+            cursor.execute("""
+                INSERT INTO simulation_stats (id, total_simulations, total_accesses)
+                SELECT 1, COUNT(*), COALESCE(SUM(access_count), 0) FROM simulations
+            """)
+            cursor.execute("""
+                INSERT INTO simulation_subject_counts (subject_id, simulation_count)
+                SELECT subject_id, COUNT(*) FROM simulations GROUP BY subject_id
+            """)
+            cursor.execute("""
+                INSERT INTO simulation_level_counts (level, simulation_count)
+                SELECT level, COUNT(*) FROM simulations GROUP BY level
+            """)
+            logger.info("Statistics tables built")
+        
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_access_count 
+            ON simulations(access_count DESC)
         """)
         
         logger.info("Database initialized successfully")
 
 
+def migrate_cache_keys(compute_key: Callable[[Dict], Optional[str]]) -> Tuple[int, int]:
+    """Rekey simulations stored under an older cache key scheme.
+    
+    Rows whose key differs from compute_key(row) get the new key, and
+    their HTML file is renamed to match. Rows that cannot be keyed
+    (compute_key returns None) or that were already regenerated under
+    the new key are deleted along with their file. Runs once per
+    database; returns (rekeyed, purged).
+    """
+    rekeyed = purged = 0
+    
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        
+        # Serialize workers starting together; the first one does the work
+        cursor.execute("BEGIN IMMEDIATE")
+        if cursor.execute("PRAGMA user_version").fetchone()[0] >= CACHE_KEY_VERSION:
+            return rekeyed, purged
+        
+        cursor.execute("""
+            SELECT id, cache_key, topic_id, chapter_id, subject_id, level, file_path
+            FROM simulations
+        """)
+        rows = [dict(row) for row in cursor.fetchall()]
+        existing_keys = {row["cache_key"] for row in rows}
+        
+        for row in rows:
+            new_key = compute_key(row)
+            if new_key == row["cache_key"]:
+                continue
+            
+            old_path = Path(row["file_path"])
+            if new_key is None or new_key in existing_keys:
+                cursor.execute("DELETE FROM simulations WHERE id = ?", (row["id"],))
+                old_path.unlink(missing_ok=True)
+                purged += 1
+                continue
+            
+            new_path = old_path.with_name(f"{new_key}{old_path.suffix}")
+            cursor.execute("""
+                UPDATE simulations SET cache_key = ?, file_path = ? WHERE id = ?
+            """, (new_key, str(new_path), row["id"]))
+            try:
+                old_path.rename(new_path)
+            except FileNotFoundError:
+                pass
+            existing_keys.add(new_key)
+            rekeyed += 1
+        
+        cursor.execute(f"PRAGMA user_version = {CACHE_KEY_VERSION}")
+    
+    return rekeyed, purged
+
+
 def insert_simulation(
     cache_key: str,
     topic: str,
@@ -83,26 +343,39 @@ def insert_simulation(
     level: int,
     simulation_type: str,
     file_path: str
-) -> int:
-    """Insert a new simulation record into the database"""
+) -> Tuple[int, bool]:
+    """
+    Insert a new simulation record into the database.
+    Returns (id, inserted); inserted is False when a row with the same cache_key already existed.
+    """
     logger.info(f"Inserting simulation - Topic: {topic}, Subject: {subject}, Level: {level}")
     
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
+        # Concurrent identical requests race to insert; the first one wins and the rest reuse its row
         cursor.execute("""
             INSERT INTO simulations (
                 cache_key, topic, topic_id, chapter, chapter_id,
                 subject, subject_id, level, simulation_type, file_path
             ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(cache_key) DO NOTHING
+            RETURNING id
         """, (
             cache_key, topic, topic_id, chapter, chapter_id,
             subject, subject_id, level, simulation_type, file_path
         ))
+        row = cursor.fetchone()
+        
+        if row is None:
+            cursor.execute("SELECT id FROM simulations WHERE cache_key = ?", (cache_key,))
+            sim_id = cursor.fetchone()["id"]
+            logger.info(f"Simulation already exists with ID: {sim_id}")
+            return sim_id, False
         
-        sim_id = cursor.lastrowid
+        sim_id = row["id"]
         logger.info(f"Simulation inserted with ID: {sim_id}")
-        return sim_id
+        return sim_id, True
 
 
 def get_simulation_by_cache_key(cache_key: str) -> Optional[Dict]:
@@ -112,71 +385,139 @@ def get_simulation_by_cache_key(cache_key: str) -> Optional[Dict]:
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        cursor.execute("""
-            SELECT * FROM simulations WHERE cache_key = ?
-        """, (cache_key,))
-        
-        row = cursor.fetchone()
-        if row:
-            # Update access statistics
+        if BATCH_ACCESS_UPDATES:
+            cursor.execute("""
+                SELECT * FROM simulations WHERE cache_key = ?
+            """, (cache_key,))
+        else:
+            # Look up and record the access in a single statement
             cursor.execute("""
                 UPDATE simulations 
                 SET accessed_at = CURRENT_TIMESTAMP,
                     access_count = access_count + 1
                 WHERE cache_key = ?
+                RETURNING *
             """, (cache_key,))
-            
-            logger.debug(f"Simulation found and access count updated for: {cache_key}")
+        
+        row = cursor.fetchone()
+        if row:
+            if BATCH_ACCESS_UPDATES:
+                record_simulation_access(cache_key)
+            logger.debug(f"Simulation found and access recorded for: {cache_key}")
             return dict(row)
         
         logger.debug(f"No simulation found for cache_key: {cache_key}")
         return None
 
 
-def get_all_simulations(
-    limit: Optional[int] = None,
-    offset: int = 0,
-    level: Optional[int] = None
-) -> List[Dict]:
-    """Get all simulation records with optional filtering"""
+def get_access_stats(cache_key: str) -> Optional[Dict]:
+    """Get the current access statistics of a simulation"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        query = "SELECT * FROM simulations WHERE 1=1"
-        params = []
-        
-        if level is not None:
-            query += " AND level = ?"
-            params.append(level)
-        
-        query += " ORDER BY created_at DESC"
-        
-        if limit:
-            query += " LIMIT ? OFFSET ?"
-            params.extend([limit, offset])
-        
-        cursor.execute(query, params)
+        cursor.execute("""
+            SELECT access_count, accessed_at FROM simulations WHERE cache_key = ?
+        """, (cache_key,))
         
-        return [dict(row) for row in cursor.fetchall()]
+        row = cursor.fetchone()
+        return dict(row) if row else None
+
+
+def record_simulation_access(cache_key: str):
+    """Record an access for a simulation, buffered until the next flush when batching"""
+    if not BATCH_ACCESS_UPDATES:
+        with get_db_connection() as conn:
+            conn.execute("""
+                UPDATE simulations 
+                SET accessed_at = CURRENT_TIMESTAMP,
+                    access_count = access_count + 1
+                WHERE cache_key = ?
+            """, (cache_key,))
+        return
+    
+    # Same format as SQLite's CURRENT_TIMESTAMP
+    accessed_at = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    with _access_lock:
+        _pending_accesses[cache_key] += 1
+        _last_accessed[cache_key] = accessed_at
 
 
-def get_simulation_count(
+def flush_pending_accesses() -> int:
+    """Write buffered access statistics in a single transaction"""
+    with _access_lock:
+        if not _pending_accesses:
+            return 0
+        updates = [
+            (count, _last_accessed[cache_key], cache_key)
+            for cache_key, count in _pending_accesses.items()
+        ]
+        _pending_accesses.clear()
+        _last_accessed.clear()
+    
+    try:
+        with get_db_connection() as conn:
+            conn.executemany("""
+                UPDATE simulations 
+                SET access_count = access_count + ?,
+                    accessed_at = ?
+                WHERE cache_key = ?
+            """, updates)
+    except Exception:
+        # Put the counts back so they are retried on the next flush
+        with _access_lock:
+            for count, accessed_at, cache_key in updates:
+                _pending_accesses[cache_key] += count
+                _last_accessed.setdefault(cache_key, accessed_at)
+        raise
+    
+    logger.debug(f"Flushed access statistics for {len(updates)} simulations")
+    return len(updates)
+
+
+def get_all_simulations(
+    limit: Optional[int] = None,
+    offset: int = 0,
     level: Optional[int] = None
-) -> int:
-    """Get total count of simulations with optional filtering"""
+) -> Tuple[List[Dict], int]:
+    """Get simulation records with optional filtering, plus the total match count"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        query = "SELECT COUNT(*) as count FROM simulations WHERE 1=1"
+        where = " WHERE 1=1"
         params = []
         
         if level is not None:
-            query += " AND level = ?"
+            where += " AND level = ?"
             params.append(level)
         
-        cursor.execute(query, params)
+        # The total comes from an uncorrelated subquery (evaluated once) rather
+        # than COUNT(*) OVER (), which would defeat the created_at index
+        query = (
+            f"SELECT {LIST_COLUMNS}, (SELECT COUNT(*) FROM simulations{where}) AS _total"
+            f" FROM simulations{where}"
+        )
+        query += " ORDER BY created_at DESC"
         
-        return cursor.fetchone()["count"]
+        page_params = params + params
+        if limit:
+            query += " LIMIT ? OFFSET ?"
+            page_params.extend([limit, offset])
+        
+        cursor.execute(query, page_params)
+        simulations = [dict(row) for row in cursor.fetchall()]
+        
+        if simulations:
+            total = simulations[0]["_total"]
+            for sim in simulations:
+                del sim["_total"]
+        elif offset:
+            # Page is past the end, so no row carries the total
+            cursor.execute("SELECT COUNT(*) as count FROM simulations" + where, params)
+            total = cursor.fetchone()["count"]
+        else:
+            total = 0
+        
+        return simulations, total
 
 
 def delete_simulation_by_cache_key(cache_key: str) -> bool:
@@ -191,17 +532,15 @@ def delete_simulation_by_cache_key(cache_key: str) -> bool:
         return cursor.rowcount > 0
 
 
-def delete_all_simulations() -> int:
-    """Delete all simulation records and return count of deleted records"""
+def delete_all_simulations() -> List[str]:
+    """Delete all simulation records and return the file paths of the deleted records"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        cursor.execute("SELECT COUNT(*) as count FROM simulations")
-        count = cursor.fetchone()["count"]
-        
-        cursor.execute("DELETE FROM simulations")
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("DELETE FROM simulations RETURNING file_path")
         
-        return count
+        return [row["file_path"] for row in cursor.fetchall()]
 
 
 def get_statistics() -> Dict:
@@ -209,14 +548,19 @@ def get_statistics() -> Dict:
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
+        # Totals are maintained by triggers; NULLs on an empty table match
+        # what SUM() and AVG() return
         cursor.execute("""
             SELECT 
-                COUNT(*) as total_simulations,
-                COUNT(DISTINCT subject_id) as unique_subjects,
-                COUNT(DISTINCT level) as unique_levels,
-                SUM(access_count) as total_accesses,
-                AVG(access_count) as avg_accesses_per_simulation
-            FROM simulations
+                total_simulations,
+                (SELECT COUNT(*) FROM simulation_subject_counts) as unique_subjects,
+                (SELECT COUNT(*) FROM simulation_level_counts) as unique_levels,
+                CASE WHEN total_simulations > 0
+                    THEN total_accesses END as total_accesses,
+                CASE WHEN total_simulations > 0
+                    THEN total_accesses * 1.0 / total_simulations END as avg_accesses_per_simulation
+            FROM simulation_stats
+            WHERE id = 1
         """)
         
         stats = dict(cursor.fetchone())
@@ -240,16 +584,35 @@ def search_simulations(
 ) -> List[Dict]:
     """Search simulations by topic, chapter, or subject"""
     if search_fields is None:
-        search_fields = ["topic", "chapter", "subject"]
+        search_fields = list(SEARCH_FIELDS)
+    
+    invalid_fields = [field for field in search_fields if field not in SEARCH_FIELDS]
+    if invalid_fields:
+        raise ValueError(f"Invalid search fields: {', '.join(invalid_fields)}")
     
     with get_db_connection() as conn:
         cursor = conn.cursor()
         
-        conditions = " OR ".join([f"{field} LIKE ?" for field in search_fields])
-        query = f"SELECT * FROM simulations WHERE {conditions} ORDER BY created_at DESC"
-        
-        search_pattern = f"%{search_term}%"
-        params = [search_pattern] * len(search_fields)
+        if len(search_term) >= MIN_FTS_TERM_LENGTH:
+            # Quote the term so it is matched as a literal substring
+            phrase = '"' + search_term.replace('"', '""') + '"'
+            match = f"{{{' '.join(search_fields)}}} : {phrase}"
+            query = f"""
+                SELECT {LIST_COLUMNS} FROM simulations
+                WHERE id IN (
+                    SELECT rowid FROM simulations_fts WHERE simulations_fts MATCH ?
+                )
+                ORDER BY created_at DESC
+            """
+            params = [match]
+        else:
+            conditions = " OR ".join([f"{field} LIKE ? ESCAPE '\\'" for field in search_fields])
+            query = f"SELECT {LIST_COLUMNS} FROM simulations WHERE {conditions} ORDER BY created_at DESC"
+            
+            # Escape LIKE wildcards so short terms match literally, like FTS
+            escaped = search_term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+            search_pattern = f"%{escaped}%"
+            params = [search_pattern] * len(search_fields)
         
         cursor.execute(query, params)
         
@@ -257,4 +620,5 @@ def search_simulations(
 
 
 # Initialize database on module import
+_init_pool()
 init_db()
\ No newline at end of file
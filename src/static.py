@@ -0,0 +1,69 @@
+from typing import Optional
+
+from starlette.datastructures import Headers, QueryParams
+from starlette.exceptions import HTTPException
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+# Suffix of the precompressed copy stored next to each HTML file
+COMPRESSED_SUFFIX = ".gz"
+
+# Query parameter carrying the file version in URLs handed out by the API
+VERSION_PARAM = "v"
+
+
+def _accepts_gzip(scope: Scope) -> bool:
+    """Check whether the client accepts gzip, honoring q-values in Accept-Encoding"""
+    accept_encoding = Headers(scope=scope).get("accept-encoding", "")
+    wildcard_q = None
+    for item in accept_encoding.lower().split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if coding in ("gzip", "x-gzip"):
+            return q > 0
+        if coding == "*":
+            wildcard_q = q
+    return wildcard_q is not None and wildcard_q > 0
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    Static files that serve the stored .gz copy of HTML files when the client accepts gzip.
+    cache_control is only sent for versioned URLs, since an unversioned URL may later serve a different file.
+    """
+
+    def __init__(self, *args, cache_control: Optional[str] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cache_control = cache_control
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if path.endswith(".html") and _accepts_gzip(scope):
+            try:
+                response = await super().get_response(path + COMPRESSED_SUFFIX, scope)
+            except HTTPException:
+                # No compressed copy, fall back to the plain file
+                pass
+            else:
+                response.headers["Content-Type"] = "text/html; charset=utf-8"
+                response.headers["Content-Encoding"] = "gzip"
+                return self._add_html_headers(response, scope)
+
+        response = await super().get_response(path, scope)
+        if path.endswith(".html"):
+            self._add_html_headers(response, scope)
+        return response
+
+    def _add_html_headers(self, response: Response, scope: Scope) -> Response:
+        """Add the headers shared by plain and compressed HTML responses"""
+        response.headers["Vary"] = "Accept-Encoding"
+        if self.cache_control and VERSION_PARAM in QueryParams(scope["query_string"]):
+            response.headers["Cache-Control"] = self.cache_control
+        return response